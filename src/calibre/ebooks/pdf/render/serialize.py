@@ -451,10 +451,8 @@ class PDFStream(object):
 
         if fmt == QImage.Format_ARGB32:
             tmask = image.constBits().asstring(4*w*h)[self.alpha_bit::4]
-            sdata = bytearray(tmask)
-            vals = set(sdata)
-            vals.discard(255)  # discard opaque pixels
-            has_alpha = bool(vals)
+            # The image has transparency iff not all alpha bytes are opaque
+            has_alpha = tmask.count(b'\xff') != len(tmask)
             if has_alpha:
                 # Blend image onto a white background as otherwise Qt will render
                 # transparent pixels as black
@@ -9,6 +9,7 @@
 #include <stdexcept>
 #include <QVector>
 #include <cmath>
+#include <algorithm>
 
 // Macros {{{
 #define SQUARE(x) (x)*(x)
@@ -26,6 +27,44 @@
 	} \
 // }}}
 
+// CPU feature detection {{{
+// The SIMD kernels are compiled for the baseline architecture, with AVX2
+// enabled per function, and selected at runtime based on the CPU.
+#if defined(_MSC_VER) && (defined(_M_X64) || defined(_M_IX86))
+#include <intrin.h>
+#include <immintrin.h>
+#define IMAGEOPS_X86_SIMD
+#define TARGET_AVX2
+static bool detect_avx2() {
+    int info[4];
+    __cpuid(info, 0);
+    if (info[0] < 7) return false;
+    __cpuid(info, 1);
+    // The CPU must support AVX and the OS must save the YMM registers
+    if (!(info[2] & (1 << 27)) || !(info[2] & (1 << 28))) return false;
+    if ((_xgetbv(0) & 6) != 6) return false;
+    __cpuidex(info, 7, 0);
+    return (info[1] & (1 << 5)) != 0;
+}
+#elif (defined(__GNUC__) || defined(__clang__)) && (defined(__x86_64__) || defined(__i386__))
+#include <immintrin.h>
+#define IMAGEOPS_X86_SIMD
+#define TARGET_AVX2 __attribute__((target("avx2")))
+static bool detect_avx2() {
+    __builtin_cpu_init();
+    return __builtin_cpu_supports("avx2");
+}
+#endif
+
+#ifdef IMAGEOPS_X86_SIMD
+static bool cpu_has_avx2() {
+    // Detected only once, the first time any kernel is run
+    static const bool ans = detect_avx2();
+    return ans;
+}
+#endif
+// }}}
+
 // Structs {{{
 typedef struct
 {
@@ -56,61 +95,126 @@ typedef struct
 // }}}
 
 // Remove borders (auto-trim) {{{
-static unsigned int read_border_row(const QImage &img, const unsigned int width, const unsigned int height, double *reds, const double fuzz, const bool top) {
-	unsigned int r = 0, c = 0, start = 0, delta = top ? 1 : -1, ans = 0;
-	const QRgb *row = NULL, *pixel = NULL;
-    double *greens = NULL, *blues = NULL;
-	double red_average = 0, green_average = 0, blue_average = 0, distance = 0, first_red = 0, first_green = 0, first_blue = 0;
-#define DISTANCE(r, g, b) (SQUARE(r - red_average) + SQUARE(g - green_average) + SQUARE(b - blue_average))
-
-    greens = reds + width + 1; blues = greens + width + 1;
+// The channels are normalized to [0, 1] and a row is part of the border if
+// the squared distance of every pixel from the average color of the row is
+// at most fuzz.
+static void border_row_sums(const QRgb *row, const unsigned int width, quint32 *sums) {
+    for (const QRgb *pixel = row; pixel < row + width; pixel++) {
+        sums[0] += qRed(*pixel); sums[1] += qGreen(*pixel); sums[2] += qBlue(*pixel);
+    }
+}
+
+static bool border_row_is_uniform(const QRgb *row, const unsigned int width, const double *average, const double fuzz) {
+    for (const QRgb *pixel = row; pixel < row + width; pixel++) {
+        if (SQUARE(qRed(*pixel) / 255.0 - average[0]) + SQUARE(qGreen(*pixel) / 255.0 - average[1]) + SQUARE(qBlue(*pixel) / 255.0 - average[2]) > fuzz) return false;
+    }
+    return true;
+}
+
+#ifdef IMAGEOPS_X86_SIMD
+TARGET_AVX2 static inline quint32 hsum_epi32(__m256i v) {
+    __m128i s = _mm_add_epi32(_mm256_castsi256_si128(v), _mm256_extracti128_si256(v, 1));
+    s = _mm_add_epi32(s, _mm_shuffle_epi32(s, 0x4e));
+    s = _mm_add_epi32(s, _mm_shuffle_epi32(s, 0xb1));
+    return (quint32)_mm_cvtsi128_si32(s);
+}
+
+TARGET_AVX2 static void border_row_sums_avx2(const QRgb *row, const unsigned int width, quint32 *sums) {
+    const __m256i mask = _mm256_set1_epi32(0xff);
+    __m256i p, red = _mm256_setzero_si256(), green = _mm256_setzero_si256(), blue = _mm256_setzero_si256();
+    unsigned int c = 0;
+
+    for (; c + 8 <= width; c += 8) {
+        p = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(row + c));
+        blue = _mm256_add_epi32(blue, _mm256_and_si256(p, mask));
+        green = _mm256_add_epi32(green, _mm256_and_si256(_mm256_srli_epi32(p, 8), mask));
+        red = _mm256_add_epi32(red, _mm256_and_si256(_mm256_srli_epi32(p, 16), mask));
+    }
+    sums[0] += hsum_epi32(red); sums[1] += hsum_epi32(green); sums[2] += hsum_epi32(blue);
+    border_row_sums(row + c, width - c, sums);
+}
+
+TARGET_AVX2 static bool border_row_is_uniform_avx2(const QRgb *row, const unsigned int width, const double *average, const double fuzz) {
+    // Four pixels at a time, in double precision with the same operations as
+    // the scalar loop, so the results are identical.
+    const __m128i mask = _mm_set1_epi32(0xff);
+    const __m256d scale = _mm256_set1_pd(255.0), limit = _mm256_set1_pd(fuzz);
+    const __m256d ar = _mm256_set1_pd(average[0]), ag = _mm256_set1_pd(average[1]), ab = _mm256_set1_pd(average[2]);
+    __m128i p;
+    __m256d r, g, b;
+    unsigned int c = 0;
+
+    for (; c + 4 <= width; c += 4) {
+        p = _mm_loadu_si128(reinterpret_cast<const __m128i*>(row + c));
+        r = _mm256_sub_pd(_mm256_div_pd(_mm256_cvtepi32_pd(_mm_and_si128(_mm_srli_epi32(p, 16), mask)), scale), ar);
+        g = _mm256_sub_pd(_mm256_div_pd(_mm256_cvtepi32_pd(_mm_and_si128(_mm_srli_epi32(p, 8), mask)), scale), ag);
+        b = _mm256_sub_pd(_mm256_div_pd(_mm256_cvtepi32_pd(_mm_and_si128(p, mask)), scale), ab);
+        r = _mm256_add_pd(_mm256_add_pd(_mm256_mul_pd(r, r), _mm256_mul_pd(g, g)), _mm256_mul_pd(b, b));
+        if (_mm256_movemask_pd(_mm256_cmp_pd(r, limit, _CMP_GT_OQ))) return false;
+    }
+    return border_row_is_uniform(row + c, width - c, average, fuzz);
+}
+#endif
+
+static void border_row_sums_dispatch(const QRgb *row, const unsigned int width, quint32 *sums) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { border_row_sums_avx2(row, width, sums); return; }
+#endif
+    border_row_sums(row, width, sums);
+}
+
+static bool border_row_is_uniform_dispatch(const QRgb *row, const unsigned int width, const double *average, const double fuzz) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) return border_row_is_uniform_avx2(row, width, average, fuzz);
+#endif
+    return border_row_is_uniform(row, width, average, fuzz);
+}
+
+static unsigned int read_border_row(const QImage &img, const unsigned int width, const unsigned int height, const double fuzz, const bool top) {
+	unsigned int r = 0, start = 0, delta = top ? 1 : -1, ans = 0;
+	const QRgb *row = NULL;
+	quint32 sums[3];
+	double average[3], first[3] = {0, 0, 0};
+#define DISTANCE(x) (SQUARE(x[0] - average[0]) + SQUARE(x[1] - average[1]) + SQUARE(x[2] - average[2]))
+
 	start = top ? 0 : height - 1;
 
 	for (r = start; top ? height - r : r > 0; r += delta) {
 		row = reinterpret_cast<const QRgb*>(img.constScanLine(r));
-        red_average = 0; green_average = 0; blue_average = 0;
-		for (c = 0, pixel = row; c < width; c++, pixel++) {
-            reds[c] = qRed(*pixel) / 255.0; greens[c] = qGreen(*pixel) / 255.0; blues[c] = qBlue(*pixel) / 255.0;
-            red_average += reds[c]; green_average += greens[c]; blue_average += blues[c];
-		}
-        red_average /= MAX(1, width); green_average /= MAX(1, width); blue_average /= MAX(1, width);
-        distance = 0;
-        for (c = 0; c < width && distance <= fuzz; c++)
-            distance = MAX(distance, DISTANCE(reds[c], greens[c], blues[c]));
-        if (distance > fuzz) break;  // row is not homogeneous
-        if (r == start) { first_red = red_average; first_green = green_average; first_blue = blue_average; }
-        else if (DISTANCE(first_red, first_green, first_blue) > fuzz) break;  // this row's average color is far from the previous row's average color
+        sums[0] = 0; sums[1] = 0; sums[2] = 0;
+        border_row_sums_dispatch(row, width, sums);
+        for (int i = 0; i < 3; i++) average[i] = sums[i] / 255.0 / std::max(1u, width);
+        if (!border_row_is_uniform_dispatch(row, width, average, fuzz)) break;  // row is not homogeneous
+        if (r == start) { first[0] = average[0]; first[1] = average[1]; first[2] = average[2]; }
+        else if (DISTANCE(first) > fuzz) break;  // this row's average color is far from the previous row's average color
         ans += 1;
 	}
+#undef DISTANCE
 	return ans;
 }
 
 QImage remove_borders(const QImage &image, double fuzz) {
     ScopedGILRelease PyGILRelease;
-	double *buf = NULL;
 	QImage img = image, timg;
 	QTransform transpose;
 	unsigned int width = img.width(), height = img.height();
 	unsigned int top_border = 0, bottom_border = 0, left_border = 0, right_border = 0;
     bool bad_alloc = false;
-    QVector<double> vbuf = QVector<double>();
 
     ENSURE32(img)
-    vbuf.resize(3*(MAX(width, height)+1));
-	buf = vbuf.data();
 	fuzz /= 255.0;
 
-	top_border = read_border_row(img, width, height, buf, fuzz, true);
+	top_border = read_border_row(img, width, height, fuzz, true);
     if (top_border < height - 1) {
-        bottom_border = read_border_row(img, width, height, buf, fuzz, false);
+        bottom_border = read_border_row(img, width, height, fuzz, false);
         if (bottom_border < height - 1) {
             transpose.rotate(90);
             timg = img.transformed(transpose);
             if (timg.isNull()) bad_alloc = true;
             else {
-                left_border = read_border_row(timg, height, width, buf, fuzz, true);
+                left_border = read_border_row(timg, height, width, fuzz, true);
                 if (left_border < width - 1) {
-                    right_border = read_border_row(timg, height, width, buf, fuzz, false);
+                    right_border = read_border_row(timg, height, width, fuzz, false);
                     if (right_border < width - 1) {
                         if (left_border || right_border || top_border || bottom_border) {
                             // printf("111111 l=%d t=%d r=%d b=%d\n", left_border, top_border, right_border, bottom_border);
@@ -128,143 +232,247 @@ QImage remove_borders(const QImage &image, double fuzz) {
 }
 // }}}
 
+static inline void grayscale_row(QRgb *row, const int width) {
+    int gray = 0;
+    for (QRgb *pixel = row; pixel < row + width; pixel++) {
+        gray = qGray(*pixel);
+        *pixel = qRgb(gray, gray, gray);
+    }
+}
+
+#ifdef IMAGEOPS_X86_SIMD
+TARGET_AVX2 static void grayscale_row_avx2(QRgb *row, const int width) {
+    // qGray() for eight pixels at a time: the weighted sum of the channels is
+    // computed with a multiply-add of the bytes against the (b, g, r, a)
+    // weights (5, 16, 11, 0), then the gray value is copied into the r, g and
+    // b bytes of each pixel.
+    const __m256i weights = _mm256_set1_epi32(0x000b1005), ones = _mm256_set1_epi16(1), opaque = _mm256_set1_epi32(0xff000000);
+    const __m256i spread = _mm256_setr_epi8(
+            0, 0, 0, -1, 4, 4, 4, -1, 8, 8, 8, -1, 12, 12, 12, -1,
+            0, 0, 0, -1, 4, 4, 4, -1, 8, 8, 8, -1, 12, 12, 12, -1);
+    __m256i p;
+    int c = 0;
+
+    for (; c + 8 <= width; c += 8) {
+        p = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(row + c));
+        p = _mm256_srli_epi32(_mm256_madd_epi16(_mm256_maddubs_epi16(p, weights), ones), 5);
+        p = _mm256_or_si256(_mm256_shuffle_epi8(p, spread), opaque);
+        _mm256_storeu_si256(reinterpret_cast<__m256i*>(row + c), p);
+    }
+    grayscale_row(row + c, width - c);
+}
+#endif
+
+static void grayscale_row_dispatch(QRgb *row, const int width) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { grayscale_row_avx2(row, width); return; }
+#endif
+    grayscale_row(row, width);
+}
+
+static inline void gray8_row(const QRgb *src, uchar *dest, const int width) {
+    for (int c = 0; c < width; c++) dest[c] = qGray(src[c]);
+}
+
+#ifdef IMAGEOPS_X86_SIMD
+TARGET_AVX2 static void gray8_row_avx2(const QRgb *src, uchar *dest, const int width) {
+    // As for grayscale_row_avx2(), but the gray values of sixteen pixels are
+    // packed into sixteen bytes of a single channel row.
+    const __m256i weights = _mm256_set1_epi32(0x000b1005), ones = _mm256_set1_epi16(1);
+    __m256i lo, hi;
+    int c = 0;
+
+    for (; c + 16 <= width; c += 16) {
+        lo = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(src + c));
+        hi = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(src + c + 8));
+        lo = _mm256_srli_epi32(_mm256_madd_epi16(_mm256_maddubs_epi16(lo, weights), ones), 5);
+        hi = _mm256_srli_epi32(_mm256_madd_epi16(_mm256_maddubs_epi16(hi, weights), ones), 5);
+        lo = _mm256_permute4x64_epi64(_mm256_packus_epi32(lo, hi), 0xd8);
+        lo = _mm256_packus_epi16(lo, lo);
+        _mm_storeu_si128(reinterpret_cast<__m128i*>(dest + c), _mm256_castsi256_si128(_mm256_permute4x64_epi64(lo, 0xd8)));
+    }
+    gray8_row(src + c, dest + c, width - c);
+}
+#endif
+
+static void gray8_row_dispatch(const QRgb *src, uchar *dest, const int width) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { gray8_row_avx2(src, dest, width); return; }
+#endif
+    gray8_row(src, dest, width);
+}
+
 QImage grayscale(const QImage &image) { // {{{
     ScopedGILRelease PyGILRelease;
     QImage img = image;
-    QRgb *row = NULL, *pixel = NULL;
-    int r = 0, gray = 0, width = img.width(), height = img.height();
+    int r = 0, width = img.width(), height = img.height();
 
     ENSURE32(img);
-    for (r = 0; r < height; r++) {
-		row = reinterpret_cast<QRgb*>(img.scanLine(r));
-        for (pixel = row; pixel < row + width; pixel++) {
-            gray = qGray(*pixel);
-            *pixel = qRgb(gray, gray, gray);
-        }
-    }
+    for (r = 0; r < height; r++) grayscale_row_dispatch(reinterpret_cast<QRgb*>(img.scanLine(r)), width);
 	return img;
 } // }}}
 
 // Convolution {{{
-#define CONVOLVE_ACC(weight, pixel) \
-    r+=((weight))*(qRed((pixel))); g+=((weight))*(qGreen((pixel))); \
-    b+=((weight))*(qBlue((pixel)));
+// Convolutions with gaussian kernels are separable, so they are done as a
+// horizontal pass over the rows followed by a vertical pass over the columns.
+// The kernels are converted to fixed point, with weights that sum to
+// 1 << CONVOLVE_SHIFT, so that the passes can use integer multiply-adds.
+#define CONVOLVE_SHIFT 14
+#define CONVOLVE_ROUND(x) (((x) + (1 << (CONVOLVE_SHIFT - 1))) >> CONVOLVE_SHIFT)
+#define KERNEL_WEIGHT(pairs, t) ((qint16)((pairs)[(t) >> 1] >> (((t) & 1) << 4)))
+#define SHARPEN_SHIFT 12
+
+static void fixed_point_kernel(const float *kernel, const int kern_width, QVector<qint32> &pairs) {
+    // The weights of consecutive taps are packed in pairs, as used by the
+    // multiply-add instructions. The rounding error is added to the center
+    // tap, so the weights sum to exactly 1 << CONVOLVE_SHIFT.
+    QVector<qint16> k(kern_width + 1, 0);
+    int i, total = 0;
+    for (i = 0; i < kern_width; i++) {
+        k[i] = (qint16)std::lround(kernel[i] * (1 << CONVOLVE_SHIFT));
+        total += k[i];
+    }
+    k[kern_width / 2] += (1 << CONVOLVE_SHIFT) - total;
+    pairs.resize((kern_width + 1) / 2);
+    for (i = 0; i < (int)pairs.size(); i++) pairs[i] = (quint16)k[2*i] | ((quint32)(quint16)k[2*i+1] << 16);
+}
 
-static QImage convolve(const QImage &image, int matrix_size, float *matrix) {
-    int i, x, y, w, h, matrix_x, matrix_y;
-    int edge = matrix_size/2;
-    QRgb *dest, *s, **scanblock;
-    const QRgb *src = NULL;
-    float *m, *normalize_matrix, normalize, r, g, b;
-    QImage img(image);
-    QVector<QRgb*> buf1 = QVector<QRgb*>(matrix_size);
-    QVector<float> buf2 = QVector<float>(matrix_size * matrix_size);
+static inline QRgb convolve_pixel(const QRgb *src, const qint32 *pairs, const int kern_width) {
+    int t, weight, r = 0, g = 0, b = 0, a = 0;
+    for (t = 0; t < kern_width; t++) {
+        weight = KERNEL_WEIGHT(pairs, t);
+        r += weight * qRed(src[t]); g += weight * qGreen(src[t]); b += weight * qBlue(src[t]); a += weight * qAlpha(src[t]);
+    }
+    return qRgba(CONVOLVE_ROUND(r), CONVOLVE_ROUND(g), CONVOLVE_ROUND(b), CONVOLVE_ROUND(a));
+}
 
-    if(!(matrix_size % 2))
-        throw std::out_of_range("Convolution kernel width must be an odd number");
+static inline QRgb convolve_column_pixel(const QRgb * const *rows, const int x, const qint32 *pairs, const int kern_width) {
+    int t, weight, r = 0, g = 0, b = 0, a = 0;
+    for (t = 0; t < kern_width; t++) {
+        weight = KERNEL_WEIGHT(pairs, t);
+        r += weight * qRed(rows[t][x]); g += weight * qGreen(rows[t][x]); b += weight * qBlue(rows[t][x]); a += weight * qAlpha(rows[t][x]);
+    }
+    return qRgba(CONVOLVE_ROUND(r), CONVOLVE_ROUND(g), CONVOLVE_ROUND(b), CONVOLVE_ROUND(a));
+}
 
-    w = img.width();
-    h = img.height();
-    if(w < 3 || h < 3) return img;
+static inline QRgb sharpen_pixel(const QRgb p, const QRgb blurred, const int weight, const int blurred_weight) {
+    // (weight * p - blurred_weight * blurred) >> SHARPEN_SHIFT, clamped, keeping the alpha of p
+#define SHARPEN(c) std::max(0, std::min(255, (weight * c(p) - blurred_weight * c(blurred) + (1 << (SHARPEN_SHIFT - 1))) >> SHARPEN_SHIFT))
+    return qRgba(SHARPEN(qRed), SHARPEN(qGreen), SHARPEN(qBlue), qAlpha(p));
+#undef SHARPEN
+}
 
-    ENSURE32(img);
+static void convolve_row(const QRgb *src, QRgb *dest, const int count, const qint32 *pairs, const int kern_width) {
+    // dest[i] = sum of k[t] * src[i + t]
+    for (int i = 0; i < count; i++) dest[i] = convolve_pixel(src + i, pairs, kern_width);
+}
 
-    QImage buffer(w, h, img.format());
-    if (buffer.isNull()) throw std::bad_alloc();
-    buf1.resize(matrix_size);
-    scanblock = buf1.data();
-    buf2.resize(matrix_size * matrix_size);
-    normalize_matrix = buf2.data();
-
-    // create normalized matrix
-    normalize = 0.0;
-    for(i=0; i < matrix_size*matrix_size; ++i)
-        normalize += matrix[i];
-    if(std::abs(normalize) <=  M_EPSILON)
-        normalize = 1.0;
-    normalize = 1.0/normalize;
-    for(i=0; i < matrix_size*matrix_size; ++i)
-        normalize_matrix[i] = normalize*matrix[i];
-
-    // apply
+static void convolve_rows(const QRgb * const *rows, QRgb *dest, const int width, const qint32 *pairs, const int kern_width) {
+    // dest[x] = sum of k[t] * rows[t][x]
+    for (int x = 0; x < width; x++) dest[x] = convolve_column_pixel(rows, x, pairs, kern_width);
+}
 
-    for(y=0; y < h; ++y){
-        src = reinterpret_cast<const QRgb*>(img.constScanLine(y));
-        dest = (QRgb *)buffer.scanLine(y);
-        // Read in scanlines to pixel neighborhood. If the scanline is outside
-        // the image use the top or bottom edge.
-        for(x=y-edge, i=0; x <= y+edge; ++i, ++x){
-            scanblock[i] = (QRgb *)
-                img.scanLine((x < 0) ? 0 : (x > h-1) ? h-1 : x);
-        }
-        // Now we are about to start processing scanlines. First handle the
-        // part where the pixel neighborhood extends off the left edge.
-        for(x=0; x-edge < 0 ; ++x){
-            r = g = b = 0.0;
-            m = normalize_matrix;
-            for(matrix_y = 0; matrix_y < matrix_size; ++matrix_y){
-                s = scanblock[matrix_y];
-                matrix_x = -edge;
-                while(x+matrix_x < 0){
-                    CONVOLVE_ACC(*m, *s);
-                    ++matrix_x; ++m;
-                }
-                while(matrix_x <= edge){
-                    CONVOLVE_ACC(*m, *s);
-                    ++matrix_x; ++m; ++s;
-                }
-            }
-            r = r < 0.0 ? 0.0 : r > 255.0 ? 255.0 : r+0.5;
-            g = g < 0.0 ? 0.0 : g > 255.0 ? 255.0 : g+0.5;
-            b = b < 0.0 ? 0.0 : b > 255.0 ? 255.0 : b+0.5;
-            *dest++ = qRgba((unsigned char)r, (unsigned char)g,
-                            (unsigned char)b, qAlpha(*src++));
-        }
-        // Okay, now process the middle part where the entire neighborhood
-        // is on the image.
-        for(; x+edge < w; ++x){
-            m = normalize_matrix;
-            r = g = b = 0.0;
-            for(matrix_y = 0; matrix_y < matrix_size; ++matrix_y){
-                s = scanblock[matrix_y] + (x-edge);
-                for(matrix_x = -edge; matrix_x <= edge; ++matrix_x, ++m, ++s){
-                    CONVOLVE_ACC(*m, *s);
-                }
-            }
-            r = r < 0.0 ? 0.0 : r > 255.0 ? 255.0 : r+0.5;
-            g = g < 0.0 ? 0.0 : g > 255.0 ? 255.0 : g+0.5;
-            b = b < 0.0 ? 0.0 : b > 255.0 ? 255.0 : b+0.5;
-            *dest++ = qRgba((unsigned char)r, (unsigned char)g,
-                            (unsigned char)b, qAlpha(*src++));
-        }
-        // Finally process the right part where the neighborhood extends off
-        // the right edge of the image
-        for(; x < w; ++x){
-            r = g = b = 0.0;
-            m = normalize_matrix;
-            for(matrix_y = 0; matrix_y < matrix_size; ++matrix_y){
-                s = scanblock[matrix_y];
-                s += x-edge;
-                matrix_x = -edge;
-                while(x+matrix_x < w){
-                    CONVOLVE_ACC(*m, *s);
-                    ++matrix_x, ++m, ++s;
-                }
-                --s;
-                while(matrix_x <= edge){
-                    CONVOLVE_ACC(*m, *s);
-                    ++matrix_x, ++m;
-                }
-            }
-            r = r < 0.0 ? 0.0 : r > 255.0 ? 255.0 : r+0.5;
-            g = g < 0.0 ? 0.0 : g > 255.0 ? 255.0 : g+0.5;
-            b = b < 0.0 ? 0.0 : b > 255.0 ? 255.0 : b+0.5;
-            *dest++ = qRgba((unsigned char)r, (unsigned char)g,
-                            (unsigned char)b, qAlpha(*src++));
-        }
+static void sharpen_row(const QRgb *src, const QRgb *blurred, QRgb *dest, const int width, const int weight, const int blurred_weight) {
+    for (int x = 0; x < width; x++) dest[x] = sharpen_pixel(src[x], blurred[x], weight, blurred_weight);
+}
+
+#ifdef IMAGEOPS_X86_SIMD
+// The AVX2 versions compute four pixels at a time. The channels of the
+// pixels for two consecutive taps are interleaved and widened to 16 bits,
+// so that a single multiply-add applies both taps to all channels.
+#define CONVOLVE_TAPS(a, b, t) { \
+    k = _mm256_set1_epi32(pairs[(t) >> 1]); \
+    lo = _mm256_add_epi32(lo, _mm256_madd_epi16(_mm256_cvtepu8_epi16(_mm_unpacklo_epi8(a, b)), k)); \
+    hi = _mm256_add_epi32(hi, _mm256_madd_epi16(_mm256_cvtepu8_epi16(_mm_unpackhi_epi8(a, b)), k)); \
+}
+#define LOAD4(p) _mm_loadu_si128(reinterpret_cast<const __m128i*>(p))
+
+TARGET_AVX2 static inline __m128i pack_convolved(__m256i lo, __m256i hi) {
+    // lo and hi hold the 32 bit channel sums of pixels 0, 1 and 2, 3, one
+    // pixel per 128 bit lane
+    lo = _mm256_srli_epi32(lo, CONVOLVE_SHIFT); hi = _mm256_srli_epi32(hi, CONVOLVE_SHIFT);
+    __m256i p = _mm256_permute4x64_epi64(_mm256_packus_epi32(lo, hi), 0xd8);
+    p = _mm256_packus_epi16(p, p);
+    return _mm_unpacklo_epi64(_mm256_castsi256_si128(p), _mm256_extracti128_si256(p, 1));
+}
+
+TARGET_AVX2 static void convolve_row_avx2(const QRgb *src, QRgb *dest, const int count, const qint32 *pairs, const int kern_width) {
+    const __m256i round = _mm256_set1_epi32(1 << (CONVOLVE_SHIFT - 1));
+    const __m128i zero = _mm_setzero_si128();
+    __m256i lo, hi, k;
+    int i = 0, t;
+
+    for (; i + 4 <= count; i += 4) {
+        lo = round; hi = round;
+        for (t = 0; t + 1 < kern_width; t += 2) CONVOLVE_TAPS(LOAD4(src + i + t), LOAD4(src + i + t + 1), t);
+        if (t < kern_width) CONVOLVE_TAPS(LOAD4(src + i + t), zero, t);
+        _mm_storeu_si128(reinterpret_cast<__m128i*>(dest + i), pack_convolved(lo, hi));
+    }
+    convolve_row(src + i, dest + i, count - i, pairs, kern_width);
+}
+
+TARGET_AVX2 static void convolve_rows_avx2(const QRgb * const *rows, QRgb *dest, const int width, const qint32 *pairs, const int kern_width) {
+    const __m256i round = _mm256_set1_epi32(1 << (CONVOLVE_SHIFT - 1));
+    const __m128i zero = _mm_setzero_si128();
+    __m256i lo, hi, k;
+    int x = 0, t;
+
+    for (; x + 4 <= width; x += 4) {
+        lo = round; hi = round;
+        for (t = 0; t + 1 < kern_width; t += 2) CONVOLVE_TAPS(LOAD4(rows[t] + x), LOAD4(rows[t + 1] + x), t);
+        if (t < kern_width) CONVOLVE_TAPS(LOAD4(rows[t] + x), zero, t);
+        _mm_storeu_si128(reinterpret_cast<__m128i*>(dest + x), pack_convolved(lo, hi));
     }
+    for (; x < width; x++) dest[x] = convolve_column_pixel(rows, x, pairs, kern_width);
+}
 
-    return buffer;
+TARGET_AVX2 static void sharpen_row_avx2(const QRgb *src, const QRgb *blurred, QRgb *dest, const int width, const int weight, const int blurred_weight) {
+    // Eight pixels at a time, with each channel of src and blurred
+    // interleaved as 16 bit pairs for a multiply-add with the weights
+    const __m256i zero = _mm256_setzero_si256(), round = _mm256_set1_epi32(1 << (SHARPEN_SHIFT - 1));
+    const __m256i alpha = _mm256_set1_epi32(0xff000000);
+    const __m256i k = _mm256_set1_epi32((quint16)weight | ((quint32)(quint16)(-blurred_weight) << 16));
+    __m256i p, b, plo, phi, blo, bhi, a, c;
+    int x = 0;
+
+#define SHARPEN4(p16, b16) _mm256_packs_epi32( \
+        _mm256_srai_epi32(_mm256_add_epi32(_mm256_madd_epi16(_mm256_unpacklo_epi16(p16, b16), k), round), SHARPEN_SHIFT), \
+        _mm256_srai_epi32(_mm256_add_epi32(_mm256_madd_epi16(_mm256_unpackhi_epi16(p16, b16), k), round), SHARPEN_SHIFT))
+    for (; x + 8 <= width; x += 8) {
+        p = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(src + x));
+        b = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(blurred + x));
+        plo = _mm256_unpacklo_epi8(p, zero); phi = _mm256_unpackhi_epi8(p, zero);
+        blo = _mm256_unpacklo_epi8(b, zero); bhi = _mm256_unpackhi_epi8(b, zero);
+        a = SHARPEN4(plo, blo); c = SHARPEN4(phi, bhi);
+        c = _mm256_blendv_epi8(_mm256_packus_epi16(a, c), p, alpha);
+        _mm256_storeu_si256(reinterpret_cast<__m256i*>(dest + x), c);
+    }
+#undef SHARPEN4
+    sharpen_row(src + x, blurred + x, dest + x, width - x, weight, blurred_weight);
+}
+#undef CONVOLVE_TAPS
+#undef LOAD4
+#endif
+
+static void convolve_row_dispatch(const QRgb *src, QRgb *dest, const int count, const qint32 *pairs, const int kern_width) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { convolve_row_avx2(src, dest, count, pairs, kern_width); return; }
+#endif
+    convolve_row(src, dest, count, pairs, kern_width);
+}
+
+static void convolve_rows_dispatch(const QRgb * const *rows, QRgb *dest, const int width, const qint32 *pairs, const int kern_width) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { convolve_rows_avx2(rows, dest, width, pairs, kern_width); return; }
+#endif
+    convolve_rows(rows, dest, width, pairs, kern_width);
+}
+
+static void sharpen_row_dispatch(const QRgb *src, const QRgb *blurred, QRgb *dest, const int width, const int weight, const int blurred_weight) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { sharpen_row_avx2(src, blurred, dest, width, weight, blurred_weight); return; }
+#endif
+    sharpen_row(src, blurred, dest, width, weight, blurred_weight);
 }
 
 static int default_convolve_matrix_size(const float radius, const float sigma, const bool quality) {
@@ -295,29 +503,62 @@ static int default_convolve_matrix_size(const float radius, const float sigma, c
 
 // }}}
 
-QImage gaussian_sharpen(const QImage &img, const float radius, const float sigma, const bool high_quality) {  // {{{
+QImage gaussian_sharpen(const QImage &image, const float radius, const float sigma, const bool high_quality) {  // {{{
+    // Convolving with a gaussian matrix whose center is replaced by -2 times
+    // the sum of the matrix, normalized, is the same as
+    // p + amount * (p - blur(p)), where blur() is a gaussian blur and amount
+    // depends only on the sum of the matrix. The gaussian being separable, the
+    // blur is done with two 1D passes instead of convolving with the full
+    // matrix. Edge pixels are repeated for the parts of the kernel outside
+    // the image.
     ScopedGILRelease PyGILRelease;
-    int matrix_size = default_convolve_matrix_size(radius, sigma, high_quality);
-    int len = matrix_size*matrix_size;
-    QVector<float> buf = QVector<float>(len);
-    float alpha, *matrix = buf.data();
-    float sigma2 = sigma*sigma*2.0;
-    float sigmaPI2 = 2.0*M_PI*sigma*sigma;
-
-    int half = matrix_size/2;
-    int x, y, i=0, j=half;
-    float normalize=0.0;
-    for(y=(-half); y <= half; ++y, --j){
-        for(x=(-half); x <= half; ++x, ++i){
-            alpha = std::exp(-((float)x*x+y*y)/sigma2);
-            matrix[i] = alpha/sigmaPI2;
-            normalize += matrix[i];
-        }
+    int kern_width = default_convolve_matrix_size(radius, sigma, high_quality), half = kern_width / 2;
+    int x, y, i, weight, w, h;
+    float sigma2 = sigma*sigma*2.0, total = 0, amount;
+    QImage img(image);
+    QVector<float> kernel(kern_width);
+    QVector<qint32> pairs;
+
+    if(!(kern_width % 2))
+        throw std::out_of_range("Convolution kernel width must be an odd number");
+
+    w = img.width();
+    h = img.height();
+    if(w < 3 || h < 3) return img;
+
+    ENSURE32(img);
+
+    for (i = 0; i < kern_width; i++) {
+        x = i - half;
+        kernel[i] = std::exp(-((float)x*x)/sigma2);
+        total += kernel[i];
+    }
+    for (i = 0; i < kern_width; i++) kernel[i] /= total;
+    fixed_point_kernel(kernel.data(), kern_width, pairs);
+    amount = total * total / (total * total + 1);
+    weight = (int)std::lround((1 + amount) * (1 << SHARPEN_SHIFT));
+
+    QImage buffer(w, h, img.format()), result(w, h, img.format());
+    if (buffer.isNull() || result.isNull()) throw std::bad_alloc();
+    QVector<QRgb> padded(w + 2 * half), blurred(w);
+    QVector<const QRgb*> rows(kern_width);
+
+    for (y = 0; y < h; y++) {
+        const QRgb *src = reinterpret_cast<const QRgb*>(img.constScanLine(y));
+        std::fill(padded.begin(), padded.begin() + half, src[0]);
+        memcpy(padded.data() + half, src, w * sizeof(QRgb));
+        std::fill(padded.begin() + half + w, padded.end(), src[w - 1]);
+        convolve_row_dispatch(padded.data(), reinterpret_cast<QRgb*>(buffer.scanLine(y)), w, pairs.data(), kern_width);
     }
 
-    matrix[i/2]=(-2.0)*normalize;
-    QImage result(convolve(img, matrix_size, matrix));
-    return(result);
+    for (y = 0; y < h; y++) {
+        for (i = 0; i < kern_width; i++)
+            rows[i] = reinterpret_cast<const QRgb*>(buffer.constScanLine(std::max(0, std::min(h - 1, y - half + i))));
+        convolve_rows_dispatch(rows.data(), blurred.data(), w, pairs.data(), kern_width);
+        sharpen_row_dispatch(reinterpret_cast<const QRgb*>(img.constScanLine(y)), blurred.data(),
+                reinterpret_cast<QRgb*>(result.scanLine(y)), w, weight, weight - (1 << SHARPEN_SHIFT));
+    }
+    return result;
 } // }}}
 
 // gaussian_blur() {{{
@@ -346,7 +587,7 @@ static void get_blur_kernel(int &kernel_width, const float sigma, QVector<float>
         kernel[i] /= normalize;
 }
 
-static void blur_scan_line(const float* kernel, const int kern_width, const QRgb *source, QRgb *destination, const int columns, const int offset) {
+static void blur_scan_line(const float* kernel, const int kern_width, const QRgb *source, QRgb *destination, const int columns, const int offset, const bool edges_only=false) {
     FloatPixel aggregate, zero;
     float scale;
     const float *k;
@@ -400,6 +641,12 @@ static void blur_scan_line(const float* kernel, const int kern_width, const QRgb
                         (unsigned char)(scale*(aggregate.blue+0.5)),
                         (unsigned char)(scale*(aggregate.alpha+0.5)));
     }
+    if (edges_only) {
+        // The pixels for which the whole kernel is inside the line have
+        // already been computed
+        dest += (columns - kern_width/2 - x) * offset;
+        x = columns - kern_width/2;
+    }
     for(; x < (columns-kern_width/2); ++x, dest+=offset){
         aggregate = zero;
         k = kernel;
@@ -437,10 +684,11 @@ static void blur_scan_line(const float* kernel, const int kern_width, const QRgb
 
 QImage gaussian_blur(const QImage &image, const float radius, const float sigma) {
     ScopedGILRelease PyGILRelease;
-    int kern_width, x, y, w, h;
-    QRgb *src;
+    int kern_width, half, x, y, i, w, h;
+    QRgb *src, *dest;
     QImage img(image);
     QVector<float> kernel;
+    QVector<qint32> pairs;
 
     if(sigma == 0.0) throw std::out_of_range("Zero sigma is invalid for convolution");
 
@@ -468,21 +716,37 @@ QImage gaussian_blur(const QImage &image, const float radius, const float sigma)
     // allocate destination image
     w = img.width();
     h = img.height();
-    QImage buffer(w, h, img.format());
-    if (buffer.isNull()) throw std::bad_alloc();
+    half = kern_width / 2;
+    QImage buffer(w, h, img.format()), result(w, h, img.format());
+    if (buffer.isNull() || result.isNull()) throw std::bad_alloc();
+    // Pixels for which the whole kernel is inside the image are computed
+    // with the fixed point convolution, the edges, where the kernel has to
+    // be renormalized, with blur_scan_line()
+    fixed_point_kernel(kernel.data(), kern_width, pairs);
+    QVector<const QRgb*> rows(kern_width);
 
     //blur image rows
-    for(y=0; y < h; ++y)
-        blur_scan_line(kernel.data(), kern_width, reinterpret_cast<const QRgb *>(img.constScanLine(y)),
-                                   reinterpret_cast<QRgb *>(buffer.scanLine(y)), img.width(), 1);
+    for(y=0; y < h; ++y) {
+        const QRgb *line = reinterpret_cast<const QRgb *>(img.constScanLine(y));
+        dest = reinterpret_cast<QRgb *>(buffer.scanLine(y));
+        if (kern_width <= w) convolve_row_dispatch(line, dest + half, w - 2 * half, pairs.data(), kern_width);
+        blur_scan_line(kernel.data(), kern_width, line, dest, w, 1, kern_width <= w);
+    }
 
-    // blur image columns
+    // blur image columns, into a separate image so that the pixels of the
+    // rows pass are not overwritten while they are still needed
     src = reinterpret_cast<QRgb *>(buffer.scanLine(0));
+    dest = reinterpret_cast<QRgb *>(result.scanLine(0));
+    if (kern_width <= h) {
+        for(y=half; y < h - half; ++y) {
+            for (i = 0; i < kern_width; i++) rows[i] = reinterpret_cast<const QRgb *>(buffer.constScanLine(y - half + i));
+            convolve_rows_dispatch(rows.data(), reinterpret_cast<QRgb *>(result.scanLine(y)), w, pairs.data(), kern_width);
+        }
+    }
     for(x=0; x < w; ++x)
-        blur_scan_line(kernel.data(), kern_width, src+x, src+x, img.height(),
-                                   img.width());
+        blur_scan_line(kernel.data(), kern_width, src+x, dest+x, h, w, kern_width <= h);
     // finish up
-    return(buffer);
+    return(result);
 }
 // }}}
 
@@ -588,10 +852,62 @@ static inline unsigned int BYTE_MUL(unsigned int x, unsigned int a) {
     return ((unsigned int)(t)) | ((unsigned int)(t >> 24));
 }
 
+static inline void blend_row(const QRgb *src, QRgb *dest, const unsigned int width) {
+    QRgb s;
+    for (unsigned int c = 0; c < width; c++) {
+        // Optimized Alpha blending, taken from qt_blend_argb32_on_argb32
+        // Since the canvas has no transparency
+        // the composite pixel is: canvas*(1-alpha) + src * alpha
+        // but src is pre-multiplied, so it is:
+        // canvas*(1-alpha) + src
+        s = src[c];
+        if (s >= 0xff000000) dest[c] = s;
+        else if (s != 0) dest[c] = s + BYTE_MUL(dest[c], qAlpha(~s));
+    }
+}
+
+#ifdef IMAGEOPS_X86_SIMD
+TARGET_AVX2 static void blend_row_avx2(const QRgb *src, QRgb *dest, const unsigned int width) {
+    // Same computation as blend_row(), eight pixels at a time. Each channel of
+    // dest is widened to 16 bits, multiplied by (255 - alpha) of the
+    // corresponding source pixel and divided by 255 with the same rounding as
+    // BYTE_MUL, so the results are identical.
+    const __m256i zero = _mm256_setzero_si256(), ones = _mm256_set1_epi8(-1), half = _mm256_set1_epi16(0x80);
+    const __m256i alpha_lo = _mm256_setr_epi8(
+            3, -1, 3, -1, 3, -1, 3, -1, 7, -1, 7, -1, 7, -1, 7, -1,
+            3, -1, 3, -1, 3, -1, 3, -1, 7, -1, 7, -1, 7, -1, 7, -1);
+    const __m256i alpha_hi = _mm256_setr_epi8(
+            11, -1, 11, -1, 11, -1, 11, -1, 15, -1, 15, -1, 15, -1, 15, -1,
+            11, -1, 11, -1, 11, -1, 11, -1, 15, -1, 15, -1, 15, -1, 15, -1);
+    __m256i s, d, ia, lo, hi;
+    unsigned int c = 0;
+
+    for (; c + 8 <= width; c += 8) {
+        s = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(src + c));
+        d = _mm256_loadu_si256(reinterpret_cast<const __m256i*>(dest + c));
+        ia = _mm256_xor_si256(s, ones);
+        lo = _mm256_mullo_epi16(_mm256_unpacklo_epi8(d, zero), _mm256_shuffle_epi8(ia, alpha_lo));
+        hi = _mm256_mullo_epi16(_mm256_unpackhi_epi8(d, zero), _mm256_shuffle_epi8(ia, alpha_hi));
+        lo = _mm256_srli_epi16(_mm256_add_epi16(_mm256_add_epi16(lo, _mm256_srli_epi16(lo, 8)), half), 8);
+        hi = _mm256_srli_epi16(_mm256_add_epi16(_mm256_add_epi16(hi, _mm256_srli_epi16(hi, 8)), half), 8);
+        d = _mm256_add_epi8(s, _mm256_packus_epi16(lo, hi));
+        _mm256_storeu_si256(reinterpret_cast<__m256i*>(dest + c), d);
+    }
+    blend_row(src + c, dest + c, width - c);
+}
+#endif
+
+static void blend_row_dispatch(const QRgb *src, QRgb *dest, const unsigned int width) {
+#ifdef IMAGEOPS_X86_SIMD
+    if (cpu_has_avx2()) { blend_row_avx2(src, dest, width); return; }
+#endif
+    blend_row(src, dest, width);
+}
+
 void overlay(const QImage &image, QImage &canvas, unsigned int left, unsigned int top) {
     ScopedGILRelease PyGILRelease;
     QImage img(image);
-    unsigned int cw = canvas.width(), ch = canvas.height(), iw = img.width(), ih = img.height(), r, c, right = 0, bottom = 0, height, width, s;
+    unsigned int cw = canvas.width(), ch = canvas.height(), iw = img.width(), ih = img.height(), r, right = 0, bottom = 0, height, width;
     const QRgb* src;
     QRgb* dest;
 
@@ -613,16 +929,7 @@ void overlay(const QImage &image, QImage &canvas, unsigned int left, unsigned in
         for (r = 0; r < height; r++) {
             src = reinterpret_cast<const QRgb*>(img.constScanLine(r));
             dest = reinterpret_cast<QRgb*>(canvas.scanLine(r + top));
-            for (c = 0; c < width; c++) {
-                // Optimized Alpha blending, taken from qt_blend_argb32_on_argb32
-                // Since the canvas has no transparency
-                // the composite pixel is: canvas*(1-alpha) + src * alpha
-                // but src is pre-multiplied, so it is:
-                // canvas*(1-alpha) + src
-                s = src[c];
-                if (s >= 0xff000000) dest[left+c] = s;
-                else if (s != 0) dest[left+c] = s + BYTE_MUL(dest[left+c], qAlpha(~s));
-            }
+            blend_row_dispatch(src, dest + left, width);
         }
     } else {
         ENSURE32(img);
@@ -635,6 +942,80 @@ void overlay(const QImage &image, QImage &canvas, unsigned int left, unsigned in
 
 } // }}}
 
+QImage flatten(const QImage &image, const QRgb bgcolor, const bool grayscale) { // {{{
+    // Blend the image onto a background of the specified color and optionally
+    // convert it to grayscale, in a single pass over the image, so that each
+    // row is processed while it is still in the cache. When converting to
+    // grayscale the result is a single channel Format_Grayscale8 image.
+    ScopedGILRelease PyGILRelease;
+    QImage img(image);
+    const QRgb bg = bgcolor | 0xff000000;
+    const bool blend = img.hasAlphaChannel();
+    int r, width = img.width(), height = img.height();
+
+    if (!blend && !grayscale) {
+        ENSURE32(img);
+        return img;
+    }
+    if (blend && img.format() != QImage::Format_ARGB32_Premultiplied) {
+        img = img.convertToFormat(QImage::Format_ARGB32_Premultiplied);
+        if (img.isNull()) throw std::bad_alloc();
+    }
+    if (!blend) { ENSURE32(img); }
+    QImage canvas(width, height, grayscale ? QImage::Format_Grayscale8 : QImage::Format_RGB32);
+    if (canvas.isNull()) throw std::bad_alloc();
+    QVector<QRgb> buf(grayscale && blend ? width : 0);
+    for (r = 0; r < height; r++) {
+        const QRgb *src = reinterpret_cast<const QRgb*>(img.constScanLine(r));
+        if (blend) {
+            QRgb *dest = grayscale ? buf.data() : reinterpret_cast<QRgb*>(canvas.scanLine(r));
+            std::fill(dest, dest + width, bg);
+            blend_row_dispatch(src, dest, width);
+            src = dest;
+        }
+        if (grayscale) gray8_row_dispatch(src, canvas.scanLine(r), width);
+    }
+    return canvas;
+} // }}}
+
+QImage add_borders(const QImage &image, unsigned int left, unsigned int top, unsigned int right, unsigned int bottom, const QRgb border_color) { // {{{
+    // Only the border strips are filled with the border color, the rest of
+    // the canvas is written directly from the image. Images with an alpha
+    // channel are blended onto the border color.
+    ScopedGILRelease PyGILRelease;
+    QImage img(image);
+    const QRgb color = border_color | 0xff000000;
+    const bool blend = img.hasAlphaChannel();
+    unsigned int iw = img.width(), ih = img.height(), width = iw + left + right, height = ih + top + bottom, r;
+    const QRgb *src;
+    QRgb *dest;
+
+    if (blend) {
+        if (img.format() != QImage::Format_ARGB32_Premultiplied) {
+            img = img.convertToFormat(QImage::Format_ARGB32_Premultiplied);
+            if (img.isNull()) throw std::bad_alloc();
+        }
+    } else { ENSURE32(img); }
+    QImage canvas(width, height, QImage::Format_RGB32);
+    if (canvas.isNull()) throw std::bad_alloc();
+
+    for (r = 0; r < height; r++) {
+        dest = reinterpret_cast<QRgb*>(canvas.scanLine(r));
+        if (r < top || r >= top + ih) {
+            std::fill(dest, dest + width, color);
+            continue;
+        }
+        src = reinterpret_cast<const QRgb*>(img.constScanLine(r - top));
+        std::fill(dest, dest + left, color);
+        if (blend) {
+            std::fill(dest + left, dest + left + iw, color);
+            blend_row_dispatch(src, dest + left, iw);
+        } else memcpy(dest + left, src, iw * sizeof(QRgb));
+        std::fill(dest + left + iw, dest + width, color);
+    }
+    return canvas;
+} // }}}
+
 QImage normalize(const QImage &image) { // {{{
     ScopedGILRelease PyGILRelease;
     IntegerPixel intensity;
@@ -873,11 +1254,15 @@ bool has_transparent_pixels(const QImage &image) {  // {{{
         if (img.isNull()) throw std::bad_alloc();
     }
     int w = image.width(), h = image.height();
+    quint64 pair = 0;
     for (int r = 0; r < h; r++) {
-        const QRgb *line = reinterpret_cast<const QRgb*>(img.constScanLine(r));
-        for (int c = 0; c < w; c++) {
-            if (qAlpha(*(line + c)) != 0xff) return true;
+        const QRgb *line = reinterpret_cast<const QRgb*>(img.constScanLine(r)), *end = line + w;
+        // Check two pixels at a time, both alpha bytes must be 0xff
+        for (; line + 2 <= end; line += 2) {
+            memcpy(&pair, line, sizeof(pair));
+            if ((pair & 0xff000000ff000000ULL) != 0xff000000ff000000ULL) return true;
         }
+        if (line < end && qAlpha(*line) != 0xff) return true;
     }
     return false;
 } // }}}
@@ -928,12 +1313,7 @@ QImage texture_image(const QImage &image, const QImage &texturei) {  // {{{
                 if (overwrite) {
                     memcpy(dest, src, xlimit * sizeof(QRgb));
                 } else {
-                    for (int c = 0; c < xlimit; c++) {
-                        // See the overlay function() for an explanation of the alpha blending code below
-                        QRgb s = src[c];
-                        if (s >= 0xff000000) dest[c] = s;
-                        else if (s != 0) dest[c] = s + BYTE_MUL(dest[c], qAlpha(~s));
-                    }
+                    blend_row_dispatch(src, dest, xlimit);
                 }
             }
             x += tw;
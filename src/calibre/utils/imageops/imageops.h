@@ -16,6 +16,8 @@ QImage gaussian_sharpen(const QImage &img, const float radius, const float sigma
 QImage gaussian_blur(const QImage &img, const float radius, const float sigma);
 QImage despeckle(const QImage &image);
 void overlay(const QImage &image, QImage &canvas, unsigned int left, unsigned int top);
+QImage flatten(const QImage &image, const QRgb bgcolor, const bool grayscale);
+QImage add_borders(const QImage &image, unsigned int left, unsigned int top, unsigned int right, unsigned int bottom, const QRgb border_color);
 QImage normalize(const QImage &image);
 QImage oil_paint(const QImage &image, const float radius=-1, const bool high_quality=true);
 QImage quantize(const QImage &image, unsigned int maximum_colors, bool dither, const QVector<QRgb> &palette);
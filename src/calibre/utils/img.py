@@ -4,13 +4,18 @@
 
 
 import errno
+import hashlib
 import os
 import shutil
+import struct
 import subprocess
 import sys
 import tempfile
+import zlib
+from collections import OrderedDict
+from functools import lru_cache, partial
 from io import BytesIO
-from threading import Thread
+from threading import Lock, local
 
 # We use explicit module imports so tracebacks when importing are more useful
 from PyQt5.QtCore import QBuffer, QByteArray, Qt
@@ -21,7 +26,7 @@ from calibre.constants import iswindows, plugins
 from calibre.ptempfile import TemporaryDirectory
 from calibre.utils.config_base import tweaks
 from calibre.utils.filenames import atomic_rename
-from calibre.utils.imghdr import what
+from calibre.utils.imghdr import identify, what
 from polyglot.builtins import string_or_bytes, unicode_type
 
 # Utilities {{{
@@ -41,12 +46,33 @@ def normalize_format_name(fmt):
     return fmt
 
 
+@lru_cache(maxsize=None)
+def mozjpeg_exe_path(name):
+    # When running from source, the system provided jpegtran/cjpeg are
+    # usually from plain libjpeg-turbo. Prefer mozjpeg builds, as the calibre
+    # binary builds do, if they are installed alongside.
+    for q in (name + '-mozjpeg', os.path.join('/opt/mozjpeg/bin', name)):
+        ans = shutil.which(q)
+        if ans:
+            return ans
+    return name
+
+
+@lru_cache(maxsize=64)
+def qcolor(spec):
+    # Colors are usually given as hex strings, avoid parsing them for every
+    # image. The returned QColor is shared, it must not be modified.
+    return QColor(spec)
+
+
 def get_exe_path(name):
     from calibre.ebooks.pdf.pdftohtml import PDFTOHTML
     base = os.path.dirname(PDFTOHTML)
     if iswindows:
         name += '-calibre.exe'
     if not base:
+        if name in ('jpegtran', 'cjpeg'):
+            return mozjpeg_exe_path(name)
         return name
     return os.path.join(base, name)
 
@@ -115,10 +141,16 @@ def null_image():
     return QImage()
 
 
-def image_from_data(data):
-    ' Create an image object from data, which should be a bytestring. '
-    if isinstance(data, QImage):
-        return data
+# A small cache of recently decoded images, as the same data is often
+# decoded repeatedly when processing covers. The cache is keyed by a hash of
+# the data and bounded both in number of entries and in memory used.
+decoded_image_cache = OrderedDict()
+decoded_image_cache_lock = Lock()
+DECODED_IMAGE_CACHE_ENTRIES = 8
+DECODED_IMAGE_CACHE_BYTES = 64 * 1024 * 1024
+
+
+def decode_image_data(data):
     i = QImage()
     if not i.loadFromData(data):
         q = what(None, data)
@@ -128,6 +160,28 @@ def image_from_data(data):
     return i
 
 
+def image_from_data(data):
+    ' Create an image object from data, which should be a bytestring. '
+    if isinstance(data, QImage):
+        return data
+    key = hashlib.blake2b(data, digest_size=16).digest()
+    with decoded_image_cache_lock:
+        i = decoded_image_cache.get(key)
+        if i is not None:
+            decoded_image_cache.move_to_end(key)
+            # QImage is copy-on-write, so callers cannot modify the cached image
+            return QImage(i)
+    i = decode_image_data(data)
+    sz = i.sizeInBytes()
+    if sz <= DECODED_IMAGE_CACHE_BYTES:
+        with decoded_image_cache_lock:
+            decoded_image_cache[key] = i
+            total = sum(x.sizeInBytes() for x in decoded_image_cache.values())
+            while len(decoded_image_cache) > DECODED_IMAGE_CACHE_ENTRIES or total > DECODED_IMAGE_CACHE_BYTES:
+                total -= decoded_image_cache.popitem(last=False)[1].sizeInBytes()
+    return QImage(i)
+
+
 def image_from_path(path):
     ' Load an image from the specified path. '
     with lopen(path, 'rb') as f:
@@ -151,6 +205,13 @@ def image_from_x(x):
 
 def image_and_format_from_data(data):
     ' Create an image object from the specified data which should be a bytestring and also return the format of the image '
+    fmt = what(None, data)
+    if fmt in ('jpeg', 'png'):
+        # Decode the common cover formats directly, without having
+        # QImageReader probe every image plugin for the format
+        i = QImage()
+        if i.loadFromData(data, fmt.upper()):
+            return i, fmt
     ba = QByteArray(data)
     buf = QBuffer(ba)
     buf.open(QBuffer.ReadOnly)
@@ -162,19 +223,86 @@ def image_and_format_from_data(data):
 # Saving images {{{
 
 
-def image_to_data(img, compression_quality=95, fmt='JPEG', png_compression_level=9, jpeg_optimized=True, jpeg_progressive=False):
+def _write_png(img, compression_level=9):
+    # Write PNG data directly, compressing all the scanlines with a single
+    # zlib call. Every row uses filter type 0, which skips the per row filter
+    # selection done by libpng. This is much faster but produces larger files
+    # than libpng for photographic images and writes no metadata chunks, so
+    # it is only used when speed has been asked for with a low compression
+    # level. Returns None for images that should be written by Qt instead.
+    fmt = img.format()
+    if fmt == QImage.Format_Grayscale8:
+        color_type, bpp = 0, 1
+    elif fmt in (QImage.Format_RGB32, QImage.Format_RGB888):
+        color_type, bpp = 2, 3
+        img = img.convertToFormat(QImage.Format_RGB888)
+    elif fmt in (QImage.Format_ARGB32, QImage.Format_ARGB32_Premultiplied, QImage.Format_RGBA8888):
+        color_type, bpp = 6, 4
+        img = img.convertToFormat(QImage.Format_RGBA8888)
+    else:
+        return
+    w, h, bpl = img.width(), img.height(), img.bytesPerLine()
+    if w < 1 or h < 1:
+        return
+    bits = img.constBits()
+    bits.setsize(bpl * h)
+    raw = memoryview(bits)
+    rowlen = w * bpp
+    # The scanlines are copied straight from the image memory into a
+    # preallocated buffer, the zero filter byte of each row is already in
+    # place as the buffer is zero filled.
+    scanlines = bytearray(h * (rowlen + 1))
+    for r in range(h):
+        o = r * (rowlen + 1) + 1
+        scanlines[o:o + rowlen] = raw[r * bpl:r * bpl + rowlen]
+    del raw
+
+    def chunk(ctype, payload):
+        return b''.join((struct.pack('>I', len(payload)), ctype, payload, struct.pack('>I', zlib.crc32(payload, zlib.crc32(ctype)))))
+
+    return b''.join((
+        b'\x89PNG\r\n\x1a\n',
+        chunk(b'IHDR', struct.pack('>IIBBBBB', w, h, 8, color_type, 0, 0, 0)),
+        chunk(b'IDAT', zlib.compress(scanlines, compression_level)),
+        chunk(b'IEND', b''),
+    ))
+
+
+# Per thread buffers that images are encoded into, reused so that the memory
+# is not reallocated for every image. A QByteArray keeps its memory when
+# resized to zero only after reserve() has been called on it.
+image_buffers = local()
+IMAGE_BUFFER_SIZE = 1024 * 1024
+IMAGE_BUFFER_MAX_SIZE = 16 * 1024 * 1024
+
+
+def image_buffer():
+    ba = getattr(image_buffers, 'ba', None)
+    if ba is None or ba.capacity() > IMAGE_BUFFER_MAX_SIZE:
+        ba = image_buffers.ba = QByteArray()
+        ba.reserve(IMAGE_BUFFER_SIZE)
+        image_buffers.buf = QBuffer(ba)
+    buf = image_buffers.buf
+    buf.close()
+    ba.resize(0)
+    buf.open(QBuffer.WriteOnly)
+    return ba, buf
+
+
+def image_to_data(img, compression_quality=95, fmt='JPEG', png_compression_level=9, jpeg_optimized=True, jpeg_progressive=False, grayscale=False):
     '''
     Serialize image to bytestring in the specified format.
 
     :param compression_quality: is for JPEG and goes from 0 to 100. 100 being lowest compression, highest image quality
-    :param png_compression_level: is for PNG and goes from 0-9. 9 being highest compression.
+    :param png_compression_level: is for PNG and goes from 0-9. 9 being highest compression. Levels 0 and 1 use a faster writer that skips row filtering.
     :param jpeg_optimized: Turns on the 'optimize' option for libjpeg which losslessly reduce file size
     :param jpeg_progressive: Turns on the 'progressive scan' option for libjpeg which allows JPEG images to be downloaded in streaming fashion
+    :param grayscale: If True, the image is saved as a single channel grayscale image. Any transparency is blended onto white.
     '''
     fmt = fmt.upper()
-    ba = QByteArray()
-    buf = QBuffer(ba)
-    buf.open(QBuffer.WriteOnly)
+    if grayscale and img.format() != QImage.Format_Grayscale8:
+        img = imageops.flatten(img, qcolor('#ffffff').rgb(), True)
+    ba, buf = image_buffer()
     if fmt == 'GIF':
         w = QImageWriter(buf, b'PNG')
         w.setQuality(90)
@@ -184,7 +312,7 @@ def image_to_data(img, compression_quality=95, fmt='JPEG', png_compression_level
     is_jpeg = fmt in ('JPG', 'JPEG')
     w = QImageWriter(buf, fmt.encode('ascii'))
     if is_jpeg:
-        if img.hasAlphaChannel():
+        if img.hasAlphaChannel() and imageops.has_transparent_pixels(img):
             img = blend_image(img)
         # QImageWriter only gained the following options in Qt 5.5
         if jpeg_optimized:
@@ -194,6 +322,10 @@ def image_to_data(img, compression_quality=95, fmt='JPEG', png_compression_level
         w.setQuality(compression_quality)
     elif fmt == 'PNG':
         cl = min(9, max(0, png_compression_level))
+        if cl <= 1:
+            ans = _write_png(img, cl)
+            if ans is not None:
+                return ans
         w.setQuality(10 * (9-cl))
     if not w.write(img):
         raise ValueError('Failed to export image as ' + fmt + ' with error: ' + w.errorString())
@@ -247,6 +379,17 @@ def save_cover_data_to(
         the image will be letterboxed (i.e., centered on a black background).
     '''
     fmt = normalize_format_name(data_fmt if path is None else os.path.splitext(path)[1][1:])
+    if fmt == 'jpeg' and isinstance(data, bytes) and resize_to is None and not (grayscale or eink or letterbox):
+        # JPEG images have no transparency, so if the image already fits
+        # it would be returned unchanged, no need to decode it
+        orig_fmt, owidth, oheight = identify(data)
+        nwidth, nheight = tweaks['maximum_cover_size'] if minify_to is None else minify_to
+        if orig_fmt == 'jpeg' and owidth > 0 and oheight > 0 and not fit_image(owidth, oheight, nwidth, nheight)[0]:
+            if path is None:
+                return data
+            with lopen(path, 'wb') as f:
+                f.write(data)
+            return
     if isinstance(data, QImage):
         img = data
         changed = True
@@ -269,22 +412,58 @@ def save_cover_data_to(
         if scaled:
             changed = True
             img = img.scaled(nwidth, nheight, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+    gray = grayscale and not eink
     if img.hasAlphaChannel():
         changed = True
-        img = blend_image(img, bgcolor)
-    if grayscale and not eink:
-        if not img.allGray():
-            changed = True
-            img = grayscale_image(img)
+        # Remove transparency and convert to grayscale in a single pass
+        img = imageops.flatten(img, qcolor(bgcolor).rgb(), gray)
+    elif gray and not img.allGray():
+        # The conversion to grayscale is done when encoding the image
+        changed = True
     if eink:
         # NOTE: Keep in mind that JPG does NOT actually support indexed colors, so the JPG algorithm will then smush everything back into a 256c mess...
         #       Thankfully, Nickel handles PNG just fine, and we potentially generate smaller files to boot, because they can be properly color indexed ;).
         img = eink_dither_image(img)
         changed = True
+    if changed:
+        data = image_to_data(img, compression_quality, fmt, compression_quality // 10, grayscale=gray)
     if path is None:
-        return image_to_data(img, compression_quality, fmt, compression_quality // 10) if changed else data
+        return data
     with lopen(path, 'wb') as f:
-        f.write(image_to_data(img, compression_quality, fmt, compression_quality // 10) if changed else data)
+        f.write(data)
+
+
+def save_cover_data_to_many(jobs, processes=None, **kw):
+    '''
+    Process many images in parallel with :func:`save_cover_data_to`.
+
+    :param jobs: An iterable of (data, path) pairs
+    :param processes: The number of worker threads, defaults to the number of CPUs
+    :return: An iterator over (index, result) pairs in the order the jobs
+        complete, where index is the position of the job in jobs and result is
+        the return value of :func:`save_cover_data_to` or the exception it raised.
+
+    All other keyword arguments are passed to :func:`save_cover_data_to`.
+    Threads are used rather than processes as Qt and imageops release the GIL
+    while working on the pixels. No QApplication is needed.
+    '''
+    from multiprocessing.pool import ThreadPool
+    from calibre import detect_ncpus
+    worker = partial(save_cover_data_to, **kw)
+
+    def process(job):
+        i, (data, path) = job
+        try:
+            return i, worker(data, path)
+        except Exception as err:
+            return i, err
+
+    pool = ThreadPool(processes=processes or detect_ncpus())
+    try:
+        for x in pool.imap_unordered(process, enumerate(jobs), chunksize=8):
+            yield x
+    finally:
+        pool.close(), pool.join()
 # }}}
 
 # Overlaying images {{{
@@ -298,7 +477,7 @@ def blend_on_canvas(img, width, height, bgcolor='#ffffff'):
         img = img.scaled(nw, nh, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
         w, h = nw, nh
     canvas = QImage(width, height, QImage.Format_RGB32)
-    canvas.fill(QColor(bgcolor))
+    canvas.fill(qcolor(bgcolor))
     overlay_image(img, canvas, (width - w)//2, (height - h)//2)
     return canvas
 
@@ -307,7 +486,7 @@ class Canvas(object):
 
     def __init__(self, width, height, bgcolor='#ffffff'):
         self.img = QImage(width, height, QImage.Format_RGB32)
-        self.img.fill(QColor(bgcolor))
+        self.img.fill(qcolor(bgcolor))
 
     def __enter__(self):
         return self
@@ -326,7 +505,7 @@ class Canvas(object):
 def create_canvas(width, height, bgcolor='#ffffff'):
     'Create a blank canvas of the specified size and color '
     img = QImage(width, height, QImage.Format_RGB32)
-    img.fill(QColor(bgcolor))
+    img.fill(qcolor(bgcolor))
     return img
 
 
@@ -349,10 +528,7 @@ def texture_image(canvas, texture):
 
 def blend_image(img, bgcolor='#ffffff'):
     ' Used to convert images that have semi-transparent pixels to opaque by blending with the specified color '
-    canvas = QImage(img.size(), QImage.Format_RGB32)
-    canvas.fill(QColor(bgcolor))
-    overlay_image(img, canvas)
-    return canvas
+    return imageops.flatten(img, qcolor(bgcolor).rgb(), False)
 # }}}
 
 # Image borders {{{
@@ -362,10 +538,7 @@ def add_borders_to_image(img, left=0, top=0, right=0, bottom=0, border_color='#f
     img = image_from_data(img)
     if not (left > 0 or right > 0 or top > 0 or bottom > 0):
         return img
-    canvas = QImage(img.width() + left + right, img.height() + top + bottom, QImage.Format_RGB32)
-    canvas.fill(QColor(border_color))
-    overlay_image(img, canvas, left, top)
-    return canvas
+    return imageops.add_borders(img, max(0, left), max(0, top), max(0, right), max(0, bottom), qcolor(border_color).rgb())
 
 
 def remove_borders_from_image(img, fuzz=None):
@@ -400,10 +573,43 @@ def clone_image(img):
     return QImage(img)
 
 
+def _fast_scale_jpeg(data, width, height, compression_quality, preserve_aspect_ratio):
+    # Scale JPEG data using Pillow. This lets libjpeg-turbo do most of the
+    # downscaling in the DCT domain while decoding (draft mode), which is much
+    # faster than decoding at full size and then scaling with Qt. Returns None
+    # if the image cannot be handled, in which case the caller should fall
+    # back to Qt.
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    try:
+        img = Image.open(BytesIO(data))
+        if img.format != 'JPEG' or img.mode not in ('RGB', 'L'):
+            return
+        w, h = img.size
+        if preserve_aspect_ratio:
+            scaled, nwidth, nheight = fit_image(w, h, width, height)
+        else:
+            scaled, nwidth, nheight = (w, h) != (width, height), width, height
+        if scaled:
+            img.draft(img.mode, (nwidth, nheight))
+            img = img.resize((nwidth, nheight), Image.LANCZOS)
+        buf = BytesIO()
+        img.save(buf, 'JPEG', quality=compression_quality, optimize=True)
+    except Exception:
+        return
+    return nwidth, nheight, buf.getvalue()
+
+
 def scale_image(data, width=60, height=80, compression_quality=70, as_png=False, preserve_aspect_ratio=True):
     ''' Scale an image, returning it as either JPEG or PNG data (bytestring).
     Transparency is alpha blended with white when converting to JPEG. Is thread
     safe and does not require a QApplication. '''
+    if not as_png and isinstance(data, bytes) and data[:3] == b'\xff\xd8\xff':
+        ans = _fast_scale_jpeg(data, width, height, compression_quality, preserve_aspect_ratio)
+        if ans is not None:
+            return ans
     # We use Qt instead of ImageMagick here because ImageMagick seems to use
     # some kind of memory pool, causing memory consumption to sky rocket.
     img = image_from_data(data)
@@ -503,7 +709,7 @@ def quantize_image(img, max_colors=256, dither=True, palette=''):
         img = blend_image(img)
     if palette and isinstance(palette, string_or_bytes):
         palette = palette.split()
-    return imageops.quantize(img, max_colors, dither, [QColor(x).rgb() for x in palette])
+    return imageops.quantize(img, max_colors, dither, [qcolor(x).rgb() for x in palette])
 
 
 def eink_dither_image(img):
@@ -532,9 +738,7 @@ def run_optimizer(file_path, cmd, as_filter=False, input_data=None):
         ext = '.jpg'
     fd, outfile = tempfile.mkstemp(dir=cwd, suffix=ext)
     try:
-        if as_filter:
-            outf = os.fdopen(fd, 'wb')
-        else:
+        if not as_filter:
             os.close(fd)
         iname, oname = os.path.basename(file_path), os.path.basename(outfile)
 
@@ -542,31 +746,27 @@ def run_optimizer(file_path, cmd, as_filter=False, input_data=None):
             cmd[cmd.index(q)] = r
         if not as_filter:
             repl(True, iname), repl(False, oname)
-        stdin = subprocess.PIPE if as_filter else None
-        stderr = subprocess.PIPE if as_filter else subprocess.STDOUT
         creationflags = subprocess.DETACHED_PROCESS if iswindows else 0
-        p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=stderr, stdin=stdin, creationflags=creationflags)
-        stderr = p.stderr if as_filter else p.stdout
         if as_filter:
-            src = input_data or open(file_path, 'rb')
-
-            def copy(src, dest):
-                try:
-                    shutil.copyfileobj(src, dest)
-                finally:
-                    src.close(), dest.close()
-            inw = Thread(name='CopyInput', target=copy, args=(src, p.stdin))
-            inw.daemon = True
-            inw.start()
-            outw = Thread(name='CopyOutput', target=copy, args=(p.stdout, outf))
-            outw.daemon = True
-            outw.start()
-        raw = force_unicode(stderr.read())
+            # Connect the child directly to the input file (or a pipe fed
+            # from input_data) and the output file, so no data is pumped
+            # through python
+            src = open(file_path, 'rb') if input_data is None else None
+            try:
+                with os.fdopen(fd, 'wb') as outf:
+                    p = subprocess.Popen(
+                        cmd, cwd=cwd, stdout=outf, stderr=subprocess.PIPE,
+                        stdin=subprocess.PIPE if src is None else src, creationflags=creationflags)
+                    raw = force_unicode(p.communicate(input_data)[1])
+            finally:
+                if src is not None:
+                    src.close()
+        else:
+            p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, creationflags=creationflags)
+            raw = force_unicode(p.stdout.read())
         if p.wait() != 0:
             return raw
         else:
-            if as_filter:
-                outw.join(60.0), inw.join(60.0)
             try:
                 sz = os.path.getsize(outfile)
             except EnvironmentError:
@@ -602,19 +802,25 @@ def optimize_png(file_path, level=7):
 
 
 def encode_jpeg(file_path, quality=80):
-    from calibre.utils.speedups import ReadOnlyFileBuffer
     quality = max(0, min(100, int(quality)))
     exe = get_exe_path('cjpeg')
     cmd = [exe] + '-optimize -progressive -maxmemory 100M -quality'.split() + [unicode_type(quality)]
     img = QImage()
     if not img.load(file_path):
         raise ValueError('%s is not a valid image file' % file_path)
-    ba = QByteArray()
-    buf = QBuffer(ba)
-    buf.open(QBuffer.WriteOnly)
-    if not img.save(buf, 'PPM'):
+    img = img.convertToFormat(QImage.Format_RGB888)
+    if img.isNull():
         raise ValueError('Failed to export image to PPM')
-    return run_optimizer(file_path, cmd, as_filter=True, input_data=ReadOnlyFileBuffer(ba.data()))
+    # Build the PPM directly from the pixel data rather than going through
+    # the Qt PPM writer, which serializes the image pixel by pixel
+    w, h, bpl = img.width(), img.height(), img.bytesPerLine()
+    raw = memoryview(img.constBits().asstring(bpl * h))
+    header = ('P6\n%d %d\n255\n' % (w, h)).encode('ascii')
+    if bpl == 3 * w:
+        data = b''.join((header, raw))
+    else:
+        data = b''.join([header] + [raw[r*bpl:r*bpl + 3*w] for r in range(h)])
+    return run_optimizer(file_path, cmd, as_filter=True, input_data=data)
 # }}}
 
 
@@ -644,6 +850,28 @@ def test():  # {{{
     despeckle_image(img)
     remove_borders_from_image(img)
     image_to_data(img, fmt='GIF')
+    odd = img.copy(0, 0, (img.width() - 1) | 1, img.height())
+    for q, expected in (
+        (img.convertToFormat(QImage.Format_ARGB32), QImage.Format_ARGB32),
+        (img.convertToFormat(QImage.Format_RGB32), QImage.Format_RGB32),
+        (img.convertToFormat(QImage.Format_Grayscale8), QImage.Format_Grayscale8),
+        (odd.convertToFormat(QImage.Format_RGB888), QImage.Format_RGB32),
+        (odd.convertToFormat(QImage.Format_Grayscale8), QImage.Format_Grayscale8),
+    ):
+        for level in (1, 9):
+            if image_from_data(image_to_data(q, fmt='PNG', png_compression_level=level)) != q.convertToFormat(expected):
+                raise SystemExit('Failed to roundtrip %s image as PNG at level %d' % (q.format(), level))
+    if not image_from_data(image_to_data(img, grayscale=True)).allGray():
+        raise SystemExit('image_to_data failed to convert to grayscale')
+    for i, ans in save_cover_data_to_many([(img, None)] * 4, minify_to=(20, 20)):
+        if not isinstance(ans, bytes):
+            raise SystemExit('save_cover_data_to_many failed: %r' % ans)
+    raw = image_to_data(img)
+    if save_cover_data_to(raw, minify_to=(img.width(), img.height())) is not raw:
+        raise SystemExit('save_cover_data_to re-encoded an unchanged JPEG')
+    w, h = scale_image(raw, 20, 20)[:2]
+    if max(w, h) != 20:
+        raise SystemExit('scale_image returned incorrect size: {}x{}'.format(w, h))
     raw = subprocess.Popen([get_exe_path('JxrDecApp'), '-h'],
                            creationflags=subprocess.DETACHED_PROCESS if iswindows else 0,
                            stdout=subprocess.PIPE).stdout.read()